@@ -1,9 +1,27 @@
 import streamlit as st
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+import os
+import hmac
+import hashlib
+import threading
+import pprint
+from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from modules.InfoLoader import InfoLoader
-from modules.VectorDB import VectorDB
+from modules.VectorDB import VectorDB, SemanticCache
+from collections import OrderedDict
 import logging
 
+# Static widget options, built once at import instead of on every rerun
+_TEMPERATURE_OPTIONS = tuple(x / 10 for x in range(0, 21))
+_UPLOAD_TYPES = ('pdf', 'txt', 'docx')
+_MAX_CHAINS = 8
+
 @st.cache_resource
 def configure_logging(file_path=None, streaming=None, level=logging.INFO):
     '''
@@ -13,9 +31,10 @@ def configure_logging(file_path=None, streaming=None, level=logging.INFO):
 
     logger = logging.getLogger()
     logger.setLevel(level)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     
-    if not len(logger.handlers):
+    if not len(logger.handlers) and (file_path or streaming):
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
         # Add a filehandler to output to a file
         if file_path:
             file_handler = logging.FileHandler(file_path, mode='a')
@@ -34,19 +53,86 @@ def configure_logging(file_path=None, streaming=None, level=logging.INFO):
 
     return logger
 
+@st.cache_resource
+def load_config(config_path='config.yml', compiled_path='config_compiled.py'):
+    '''
+    Loads the config, runs once due to caching
+    Imports the precompiled config module, the yaml is only parsed (and recompiled) if it is newer
+    '''
+    if os.path.exists(compiled_path) and os.path.getmtime(config_path) <= os.path.getmtime(compiled_path):
+        try:
+            from config_compiled import CONFIG
+            return CONFIG
+        except Exception:
+            logging.getLogger(__name__).warning('Could not import compiled config, parsing yaml', exc_info=True)
+
+    with open(config_path, 'r') as file:
+        config = yaml.load(file, Loader=SafeLoader)
+    # Write to a temp file and move it into place, so a half-written module is never imported
+    try:
+        with NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(compiled_path)), suffix='.tmp', delete=False) as file:
+            file.write(f'CONFIG = {pprint.pformat(config)}\n')
+        os.replace(file.name, compiled_path)
+    except OSError:
+        logging.getLogger(__name__).warning('Could not write compiled config', exc_info=True)
+    return config
+
 def initialize_session_state():
     '''
     Handles initializing of session_state variables
     '''
-    # Load config if not yet loaded
+    # Config is parsed once per process and shared across sessions
     if 'config' not in st.session_state:
-        with open('config.yml', 'r') as file:
-            st.session_state.config = yaml.safe_load(file)
+        st.session_state.config = load_config()
             
     # Create an API call counter, to cap usage
     if 'usage_counter' not in st.session_state:
         st.session_state.usage_counter = 0
-    st.session_state.openai_api_key_host = st.secrets["apikey"]
+    if 'openai_api_key_host' not in st.session_state:
+        st.session_state.openai_api_key_host = st.secrets["apikey"]
+    # Semantic caches are per session, responses contain the user's personal details
+    if 'semantic_caches' not in st.session_state:
+        st.session_state.semantic_caches = OrderedDict()
+
+@st.cache_data
+def _host_password():
+    '''
+    Reads the host password from the secrets once
+    '''
+    return st.secrets['password']
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _chunk_one(file_hash, file_name, _loader, _file):
+    '''
+    Chunks a single upload, cached on the hash of its contents so identical files are only parsed once
+    '''
+    return _loader.parse_one(_loader.save_upload(_file), file_name)
+
+
+@st.cache_resource(max_entries=_MAX_CHAINS)
+def _get_chain(api_key_hash, temperature, prompt_mode, source, db_version, _vector_db, _openai_api_key):
+    '''
+    Builds the llm and QA chain once per key hash, settings and database version, the raw key stays out of the cache key
+    '''
+    llm = _vector_db.create_llm(_openai_api_key, temperature)
+    return _vector_db.create_chain(llm, prompt_mode, source)
+
+
+def get_semantic_cache(chain_key : tuple):
+    '''
+    Returns this session's semantic cache for a chain, keeps as many caches as there are cached chains
+    '''
+    semantic_caches = st.session_state.semantic_caches
+    if chain_key not in semantic_caches:
+        if len(semantic_caches) >= _MAX_CHAINS:
+            semantic_caches.popitem(last=False)
+        semantic_caches[chain_key] = SemanticCache(
+            threshold=st.session_state.config['semantic_cache']['threshold'],
+            max_entries=st.session_state.config['semantic_cache']['max_entries']
+            )
+    semantic_caches.move_to_end(chain_key)
+    return semantic_caches[chain_key]
 
         
 @st.cache_resource
@@ -54,7 +140,8 @@ def get_resources():
     '''
     Initializes the customer modules
     '''
-    return InfoLoader(st.session_state.config), VectorDB(st.session_state.config)
+    config = load_config()
+    return InfoLoader(config), VectorDB(config)
 
 def main():
     '''
@@ -63,47 +150,76 @@ def main():
     # Load configs, logger, classes
     st.set_page_config(page_title="Bewerbungsbot ")
     initialize_session_state()    
-    if st.session_state.config['local']:
+    # Read session_state once, writes still go through st.session_state so they persist
+    config = st.session_state.config
+    openai_api_key_host = st.session_state.openai_api_key_host
+    if config['local']:
         logger = configure_logging('app.log')
     else: 
         logger = configure_logging(streaming=True)
     loader, vector_db = get_resources()  
+    try:
+        vector_db.load_database(openai_api_key_host)
+    except Exception as e:
+        logger.error('Exception during loading of the saved vector_db', exc_info=True)
 
     #------------------------------------ SIDEBAR ----------------------------------------#
     with st.sidebar:
         # API option, whether to use host's API key (must be enabled by config), and also to cap usage
-        openai_api_key = st.session_state.openai_api_key_host
+        openai_api_key = openai_api_key_host
         password = st.text_input(label = "Passwort", help = "Passwort hier eingeben.", type= 'password')
         # Document uploader
         uploaded_files = st.file_uploader(
             label = 'Dokumente hier hochladen', 
             help = 'Bereits existierende Dokumente werden überschrieben',
-            type = ['pdf', 'txt', 'docx'], 
+            type = _UPLOAD_TYPES, 
             accept_multiple_files=True
             )
 
-        if st.button('Hochladen', type='primary') and (uploaded_files) and password == st.secrets['password']:
+        if st.button('Hochladen', type='primary') and uploaded_files and password and hmac.compare_digest(password.encode(), _host_password().encode()):
             with st.status('Lade hoch (das kann einen Moment dauern)...)', expanded=True) as status:
                 try:
-                    st.write("Dokumente werden verarbeitet...")
-                    loader.get_chunks(uploaded_files)
-                    st.write("Embeddings werden erstellt...")
+                    st.write("Dokumente werden verarbeitet und Embeddings erstellt...")
                     vector_db.create_embedding_function(openai_api_key)
-                    vector_db.initialize_database(loader.document_chunks_full, loader.document_names)
+                    # Results per upload position, so the documents keep their upload order
+                    parsed_files = [None] * len(uploaded_files)
+                    # Hash the contents once, so re-uploaded files are served from the chunk cache
+                    file_hashes = [hashlib.sha256(file.getvalue()).hexdigest() for file in uploaded_files]
+                    # Parse files in parallel, embed each one as soon as it is ready while the rest are still parsing
+                    # Worker threads get the script context so the cache can be used from them
+                    ctx = get_script_run_ctx()
+                    with ThreadPoolExecutor(
+                        max_workers=min(8, len(uploaded_files)),
+                        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+                        ) as executor:
+                        futures = {
+                            executor.submit(_chunk_one, file_hash, file.name, loader, file): file_index
+                            for file_index, (file_hash, file) in enumerate(zip(file_hashes, uploaded_files))
+                            }
+                        for future in as_completed(futures):
+                            title, document_chunks = future.result()
+                            parsed_files[futures[future]] = (title, document_chunks, vector_db.embed_documents(document_chunks))
+                    document_names = [title for title, _, _ in parsed_files]
+                    document_chunks_full = [chunk for _, document_chunks, _ in parsed_files for chunk in document_chunks]
+                    embeddings = [embedding for _, _, file_embeddings in parsed_files for embedding in file_embeddings]
+                    # Only replaces the existing documents once every file went through
+                    vector_db.initialize_database(document_chunks_full, document_names, embeddings)
+                    vector_db.save_database()
 
                 except Exception as e:
                     logger.error('Exception during Splitting / embedding', exc_info=True)
                     status.update(label='Error occured.', state='error', expanded=False)
                 else:
                     # If successful, increment the usage based on number of documents
-                    if openai_api_key == st.session_state.openai_api_key_host:
-                        st.session_state.usage_counter += len(loader.document_names)
-                        logger.info(f'Current usage counter: {st.session_state.usage_counter}')
-                    logger.info(f'Erfolgreich hochgeladen: {loader.document_names}')
+                    if openai_api_key == openai_api_key_host:
+                        usage_counter = st.session_state.usage_counter + len(document_names)
+                        st.session_state.usage_counter = usage_counter
+                        logger.info('Current usage counter: %s', usage_counter)
+                    logger.info('Erfolgreich hochgeladen: %s', document_names)
                     status.update(label='Embedding vollständig!', state='complete', expanded=False)
         temperature = st.select_slider(
         'Kreativität', 
-        options=[x / 10 for x in range(0, 21)],
+        options=_TEMPERATURE_OPTIONS,
         value= 1.0,
         help='Je höher der Wert, desto größer ist der Zufallseinfluss beim Erstellen des Anschreibens \n\
             Ein Wert von 1 ist ideal.',
@@ -114,12 +230,9 @@ def main():
     st.markdown("## :rocket: Willkommen zu deinem Bewerbungs-Assistenten")
 
     # Info bar
-    if vector_db.document_names:
-        doc_name_display = ''
-        for doc_count, doc_name in enumerate(vector_db.document_names):
-            doc_name_display += str(doc_count+1) + '. ' + doc_name + '\n\n'
-    else:
-        doc_name_display = 'Noch keine Dokumente hochgeladen!'
+    doc_name_display = '\n\n'.join(
+        f'{doc_count}. {doc_name}' for doc_count, doc_name in enumerate(vector_db.document_names or [], 1)
+        ) or 'Noch keine Dokumente hochgeladen!'
     st.info(f"Hochgeladene Dokumente: \n\n {doc_name_display}", icon='ℹ️')
     if (not openai_api_key.startswith('sk-')) or (openai_api_key=='NA'):
         st.write('Enter your API key on the sidebar to begin')
@@ -149,19 +262,18 @@ def main():
                 st.warning('Please enter your OpenAI API key!', icon='⚠')
 
         #----------------------------------------- Submit a prompt ----------------------------------#
-        if st.form_submit_button('Absenden', type='primary') and openai_api_key.startswith('sk-') and password == st.secrets['password']:
+        if st.form_submit_button('Absenden', type='primary') and openai_api_key.startswith('sk-') and password and hmac.compare_digest(password.encode(), _host_password().encode()):
             with st.spinner('Lade...'):
                 try:
                     result = None
-                    vector_db.create_llm(
-                        openai_api_key,
-                        temperature
-                    )
-                    vector_db.create_chain(
-                        prompt_mode,
-                        source
-                    )
-                    result = vector_db.get_response(user_instructions + " " + user_information + " " +  user_input)
+                    chain_key = (hashlib.sha256(openai_api_key.encode()).hexdigest(), temperature, prompt_mode, source, vector_db.db_version)
+                    qa_chain = _get_chain(*chain_key, vector_db, openai_api_key)
+                    # Only deterministic answers are reused, with any creativity a resubmit should give a new letter
+                    use_cache = config['semantic_cache']['use_cache'] and temperature == 0
+                    semantic_cache = get_semantic_cache(chain_key) if use_cache else None
+                    # Join the non-empty fields once, so blank inputs don't add stray spaces to the prompt
+                    prompt = ' '.join(field for field in (user_instructions.strip(), user_information.strip(), user_input.strip()) if field)
+                    result = vector_db.get_response(prompt, qa_chain, semantic_cache)
                 except Exception as e:
                     logger.error('Exception during Querying', exc_info=True)
                     st.error('Error occured, unable to process response!', icon="🚨")
@@ -1,4 +1,6 @@
+import os
 import re
+import shutil
 import pysrt
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.document_loaders import PyMuPDFLoader, Docx2txtLoader, YoutubeLoader, WebBaseLoader, TextLoader
@@ -17,10 +19,6 @@ class InfoLoader():
         self.config = config
         self.remove_leftover_delimiters = config['splitter_options']['remove_leftover_delimiters']
 
-        # Main list of all documents
-        self.document_chunks_full = []
-        self.document_names = []
-
         if config['splitter_options']['use_splitter']:
             if config['splitter_options']['split_by_token']:
                 self.splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
@@ -38,185 +36,185 @@ class InfoLoader():
             self.splitter = None
         logger.info('InfoLoader instance created')
 
-    def get_chunks(self, uploaded_files):
-        # Main list of all documents
-        self.document_chunks_full = []
-        self.document_names = []
-        
-        def remove_delimiters(document_chunks : list):
-            '''
-            Helper function to remove remaining delimiters in document chunks
-            '''
-            for chunk in document_chunks:
-                for delimiter in self.config['splitter_options']['delimiters_to_remove']:
-                    chunk.page_content = re.sub(delimiter, ' ', chunk.page_content)
-            return document_chunks
-
-        def remove_chunks(document_chunks : list):
-            '''
-            Helper function to remove any unwanted document chunks after splitting
-            '''
-            front = self.config['splitter_options']['front_chunk_to_remove']
-            end = self.config['splitter_options']['last_chunks_to_remove']
-            # Remove pages
-            for _ in range(front):
-                del document_chunks[0]
-            for _ in range(end):
-                document_chunks.pop()
-                logger.info(f'\tNumber of pages after skipping: {len(document_chunks)}')
-            return document_chunks
-
-        def get_pdf(temp_file_path : str, title : str):
-            '''
-            Function to process PDF files
-            '''
-            loader = PyMuPDFLoader(temp_file_path) #This loader preserves more metadata
-
-            if self.splitter:
-                document_chunks = self.splitter.split_documents(loader.load())
-            else:
-                document_chunks = loader.load()
+    def remove_delimiters(self, document_chunks : list):
+        '''
+        Helper function to remove remaining delimiters in document chunks
+        '''
+        for chunk in document_chunks:
+            for delimiter in self.config['splitter_options']['delimiters_to_remove']:
+                chunk.page_content = re.sub(delimiter, ' ', chunk.page_content)
+        return document_chunks
 
-            if 'title' in document_chunks[0].metadata.keys():
-                title = document_chunks[0].metadata['title']
+    def remove_chunks(self, document_chunks : list):
+        '''
+        Helper function to remove any unwanted document chunks after splitting
+        '''
+        front = self.config['splitter_options']['front_chunk_to_remove']
+        end = self.config['splitter_options']['last_chunks_to_remove']
+        # Remove pages
+        for _ in range(front):
+            del document_chunks[0]
+        for _ in range(end):
+            document_chunks.pop()
+            logger.info(f'\tNumber of pages after skipping: {len(document_chunks)}')
+        return document_chunks
+
+    def get_pdf(self, temp_file_path : str, title : str):
+        '''
+        Function to process PDF files
+        '''
+        loader = PyMuPDFLoader(temp_file_path) #This loader preserves more metadata
 
-            logger.info(f"\t\tOriginal no. of pages: {document_chunks[0].metadata['total_pages']}")
+        if self.splitter:
+            document_chunks = self.splitter.split_documents(loader.load())
+        else:
+            document_chunks = loader.load()
 
-            return title, document_chunks
+        if 'title' in document_chunks[0].metadata.keys():
+            title = document_chunks[0].metadata['title']
 
-        def get_txt(temp_file_path : str, title : str):
-            '''
-            Function to process TXT files
-            '''
-            loader = TextLoader(temp_file_path, autodetect_encoding=True)
+        logger.info(f"\t\tOriginal no. of pages: {document_chunks[0].metadata['total_pages']}")
 
-            if self.splitter:
-                document_chunks = self.splitter.split_documents(loader.load())
-            else:
-                document_chunks = loader.load()
-
-            # Update the metadata
-            for chunk in document_chunks:
-                chunk.metadata['source'] = title
-                chunk.metadata['page'] = 'N/A'
-
-            return title, document_chunks
-
-        def get_srt(temp_file_path : str, title : str):
-            '''
-            Function to process SRT files
-            '''
-            subs = pysrt.open(temp_file_path)
-
-            text = ''
-            for sub in subs:
-                text += sub.text
-            document_chunks = [Document(page_content=text)]
-            
-            if self.splitter:
-                document_chunks = self.splitter.split_documents(document_chunks)
-
-            # Update the metadata
-            for chunk in document_chunks:
-                chunk.metadata['source'] = title
-                chunk.metadata['page'] = 'N/A'
-
-            return title, document_chunks
-
-        def get_docx(temp_file_path : str, title : str):
-            '''
-            Function to process DOCX files
-            '''
-            loader = Docx2txtLoader(temp_file_path)
-
-            if self.splitter:
-                document_chunks = self.splitter.split_documents(loader.load())
-            else:
-                document_chunks = loader.load()
-
-            # Update the metadata
-            for chunk in document_chunks:
-                chunk.metadata['source'] = title
-                chunk.metadata['page'] = 'N/A'
-
-            return title, document_chunks
-
-        def get_youtube_transcript(url : str):
-            '''
-            Function to retrieve youtube transcript and process text
-            '''
-            loader = YoutubeLoader.from_youtube_url(
-                url, 
-                add_video_info=True,
-                language=["en"],
-                translation="en"
-            )
-
-            if self.splitter:
-                document_chunks = self.splitter.split_documents(loader.load())
-            else:
-                document_chunks = loader.load_and_split()   
+        return title, document_chunks
 
-            # Replace the source with title (for display in st UI later)
-            for chunk in document_chunks:
-                chunk.metadata['source'] = chunk.metadata['title']
-            logger.info(chunk.metadata['title'])
+    def get_txt(self, temp_file_path : str, title : str):
+        '''
+        Function to process TXT files
+        '''
+        loader = TextLoader(temp_file_path, autodetect_encoding=True)
 
-            return title, document_chunks
+        if self.splitter:
+            document_chunks = self.splitter.split_documents(loader.load())
+        else:
+            document_chunks = loader.load()
 
-        def get_html(url : str):
-            '''
-            Function to process websites via HTML files
-            '''
-            loader = WebBaseLoader(url)
+        # Update the metadata
+        for chunk in document_chunks:
+            chunk.metadata['source'] = title
+            chunk.metadata['page'] = 'N/A'
 
-            if self.splitter:
-                document_chunks = self.splitter.split_documents(loader.load())
-            else:
-                document_chunks = loader.load_and_split()
-            
-            title = document_chunks[0].metadata['title']
-            logger.info(document_chunks[0].metadata)
+        return title, document_chunks
 
-            return title, document_chunks
+    def get_srt(self, temp_file_path : str, title : str):
+        '''
+        Function to process SRT files
+        '''
+        subs = pysrt.open(temp_file_path)
 
-        # Handle file by file
-        for file_index, file in enumerate(uploaded_files):
+        text = ''
+        for sub in subs:
+            text += sub.text
+        document_chunks = [Document(page_content=text)]
+        
+        if self.splitter:
+            document_chunks = self.splitter.split_documents(document_chunks)
 
-            # Get the file type and file name
-            file_type = file.name.split('.')[-1].lower()
-            logger.info(f'\tSplitting file {file_index+1} : {file.name}')
-            file_name = ''.join(file.name.split('.')[:-1])
+        # Update the metadata
+        for chunk in document_chunks:
+            chunk.metadata['source'] = title
+            chunk.metadata['page'] = 'N/A'
 
-            with NamedTemporaryFile(delete=False, suffix=f".{file_type}") as temp_file:
-                temp_file_path = temp_file.name
-                temp_file.write(file.read())
+        return title, document_chunks
 
-            # Handle different file types
-            if file_type =='pdf':
-                title, document_chunks = get_pdf(temp_file_path, file_name)
-            elif file_type == 'txt':
-                title, document_chunks = get_txt(temp_file_path, file_name)
-            elif file_type == 'docx':
-                title, document_chunks = get_docx(temp_file_path, file_name)
-            elif file_type == 'srt':
-                title, document_chunks = get_srt(temp_file_path, file_name)
+    def get_docx(self, temp_file_path : str, title : str):
+        '''
+        Function to process DOCX files
+        '''
+        loader = Docx2txtLoader(temp_file_path)
+
+        if self.splitter:
+            document_chunks = self.splitter.split_documents(loader.load())
+        else:
+            document_chunks = loader.load()
+
+        # Update the metadata
+        for chunk in document_chunks:
+            chunk.metadata['source'] = title
+            chunk.metadata['page'] = 'N/A'
 
-            # Additional wrangling - Remove leftover delimiters and any specified chunks
-            if self.remove_leftover_delimiters:
-                document_chunks = remove_delimiters(document_chunks)
-            if self.config['splitter_options']['remove_chunks']:
-                document_chunks = remove_chunks(document_chunks)
+        return title, document_chunks
 
-            logger.info(f'\t\tExtracted no. of chunks: {len(document_chunks)}')
-            self.document_names.append(title)
-            self.document_chunks_full.extend(document_chunks)
+    def get_youtube_transcript(self, url : str):
+        '''
+        Function to retrieve youtube transcript and process text
+        '''
+        loader = YoutubeLoader.from_youtube_url(
+            url, 
+            add_video_info=True,
+            language=["en"],
+            translation="en"
+        )
+
+        if self.splitter:
+            document_chunks = self.splitter.split_documents(loader.load())
+        else:
+            document_chunks = loader.load_and_split()   
 
-        logger.info(f'\tNumber of document chunks extracted in total: {len(self.document_chunks_full)}\n\n')
+        # Replace the source with title (for display in st UI later)
+        for chunk in document_chunks:
+            chunk.metadata['source'] = chunk.metadata['title']
+        logger.info(chunk.metadata['title'])
 
-    
+        return title, document_chunks
 
-    
+    def get_html(self, url : str):
+        '''
+        Function to process websites via HTML files
+        '''
+        loader = WebBaseLoader(url)
 
+        if self.splitter:
+            document_chunks = self.splitter.split_documents(loader.load())
+        else:
+            document_chunks = loader.load_and_split()
         
-        
+        title = document_chunks[0].metadata['title']
+        logger.info(document_chunks[0].metadata)
+
+        return title, document_chunks
+
+    @staticmethod
+    def save_upload(file):
+        '''
+        Streams an uploaded file to a temporary file on disk
+        Returns the path of the temporary file
+        '''
+        file_type = file.name.split('.')[-1].lower()
+        file.seek(0)
+        with NamedTemporaryFile(delete=False, suffix=f".{file_type}") as temp_file:
+            shutil.copyfileobj(file, temp_file)
+        return temp_file.name
+
+    def parse_one(self, temp_file_path : str, file_name : str = None):
+        '''
+        Splits a single file on disk into chunks, does not touch the instance's document lists
+        so it can be run for several files concurrently. The file is removed once it is chunked.
+        Returns the title and the list of document chunks
+        '''
+        # Get the file type and file name
+        file_name = file_name or os.path.basename(temp_file_path)
+        file_type = file_name.split('.')[-1].lower()
+        logger.info(f'\tSplitting file: {file_name}')
+        file_name = ''.join(file_name.split('.')[:-1])
+
+        # Handle different file types
+        try:
+            if file_type =='pdf':
+                title, document_chunks = self.get_pdf(temp_file_path, file_name)
+            elif file_type == 'txt':
+                title, document_chunks = self.get_txt(temp_file_path, file_name)
+            elif file_type == 'docx':
+                title, document_chunks = self.get_docx(temp_file_path, file_name)
+            elif file_type == 'srt':
+                title, document_chunks = self.get_srt(temp_file_path, file_name)
+        finally:
+            os.remove(temp_file_path)
+
+        # Additional wrangling - Remove leftover delimiters and any specified chunks
+        if self.remove_leftover_delimiters:
+            document_chunks = self.remove_delimiters(document_chunks)
+        if self.config['splitter_options']['remove_chunks']:
+            document_chunks = self.remove_chunks(document_chunks)
+
+        logger.info(f'\t\tExtracted no. of chunks: {len(document_chunks)}')
+        return title, document_chunks
@@ -1,18 +1,95 @@
 from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.vectorstores import FAISS
+from langchain.docstore import InMemoryDocstore
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
-from langchain.retrievers import WikipediaRetriever
+from langchain.retrievers import WikipediaRetriever, ContextualCompressionRetriever
+from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
 from langchain.callbacks import get_openai_callback
+from typing import Any
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+import os
+import threading
+import pickle
+import faiss
+import tiktoken
+import numpy as np
 import logging
 logger = logging.getLogger(__name__)
 
+class CrossEncoderRerank(BaseDocumentCompressor):
+    '''
+    Document compressor that rescores retrieved chunks with a cross-encoder and keeps only the top_n best
+    '''
+    model: Any
+    top_n: int = 3
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def compress_documents(self, documents, query, callbacks=None):
+        if not documents:
+            return []
+        scores = self.model.predict([(query, document.page_content) for document in documents])
+        ranked = sorted(zip(scores, documents), key=lambda pair: pair[0], reverse=True)
+        return [document for _, document in ranked[:self.top_n]]
+
+class SemanticCache():
+    def __init__(self, threshold : float, max_entries : int):
+        '''
+        Small in-memory cache of responses, looked up by cosine similarity of the query embedding
+        Inputs:
+            threshold - minimum similarity for a cached response to be returned
+            max_entries - number of responses kept, least recently used ones are evicted first
+        '''
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.index = None
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _to_vector(embedding : list):
+        vector = np.array([embedding], dtype=np.float32)
+        faiss.normalize_L2(vector) # Inner product of unit vectors is the cosine similarity
+        return vector
+
+    def get(self, embedding : list):
+        with self.lock:
+            if not self.entries:
+                return None
+            scores, ids = self.index.search(self._to_vector(embedding), 1)
+            if scores[0][0] < self.threshold:
+                return None
+            self.entries.move_to_end(int(ids[0][0]))
+            return self.entries[int(ids[0][0])]
+
+    def add(self, embedding : list, result : dict):
+        with self.lock:
+            if self.index is None:
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(len(embedding)))
+            if len(self.entries) >= self.max_entries:
+                oldest_id, _ = self.entries.popitem(last=False)
+                self.index.remove_ids(np.array([oldest_id], dtype=np.int64))
+            self.index.add_with_ids(self._to_vector(embedding), np.array([self.next_id], dtype=np.int64))
+            self.entries[self.next_id] = result
+            self.next_id += 1
+
 class VectorDB():
     def __init__(self, config):
         self.config = config
         self.db_option = config['embedding_options']['db_option']
         self.document_names = None
+        self.vector_db = None
+        self.db_version = 0
+        self.reranker = None
+        self.encoding = None
+        self.database_loaded = False
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
         logger.info('VectorDB instance created')
 
     def create_embedding_function(self, openai_api_key : str):
@@ -20,32 +97,149 @@ class VectorDB():
         self.embedding_function = OpenAIEmbeddings(
             deployment="SL-document_embedder",
             model=self.config['embedding_options']['model'],
+            chunk_size=min(self.config['embedding_options'].get('batch_size', 1000), 2048), # Chunks per embeddings request, API caps at 2048 inputs
             show_progress_bar=True,
             openai_api_key = openai_api_key) 
     
-    def initialize_database(self, document_chunks : list, document_names : list):
-        # Track tokem usage
+    def embed_documents(self, document_chunks : list):
+        # Embed chunks without touching the database, so files can be embedded as they are parsed
+        # Requests are packed by token count, OpenAIEmbeddings only batches by number of inputs
+        if not document_chunks:
+            return []
+        if self.encoding is None:
+            self.encoding = tiktoken.encoding_for_model(self.config['embedding_options']['model'])
+        token_budget = self.config['embedding_options']['batch_token_budget']
+        embeddings, batch, batch_tokens = [], [], 0
+        for chunk in document_chunks:
+            tokens = len(self.encoding.encode(chunk.page_content))
+            if batch and batch_tokens + tokens > token_budget:
+                embeddings.extend(self.embedding_function.embed_documents(batch))
+                batch, batch_tokens = [], 0
+            batch.append(chunk.page_content)
+            batch_tokens += tokens
+        embeddings.extend(self.embedding_function.embed_documents(batch))
+        return embeddings
+
+    def initialize_database(self, document_chunks : list, document_names : list, embeddings : list = None):
+        # Build the new database on the side and only swap it in once it is complete,
+        # so a failed upload leaves the existing documents untouched
         logger.info('Initializing vector_db')
+        if embeddings is None:
+            embeddings = self.embed_documents(document_chunks)
+        if not document_chunks:
+            raise ValueError('No document chunks to build the database from')
         if self.db_option == 'FAISS':
             logger.info('\tRunning in memory')
-            self.vector_db = FAISS.from_documents(
-                documents = document_chunks, 
-                embedding = self.embedding_function
-                )
+            # SQ8 needs enough vectors to train its value ranges, small uploads stay on the exact float32 index
+            if self.config['embedding_options']['quantize'] and len(embeddings) >= self.config['embedding_options']['quantize_min_vectors']:
+                vector_db = self.create_quantized_database(document_chunks, embeddings)
+            else:
+                vector_db = FAISS.from_embeddings(
+                    text_embeddings = zip([chunk.page_content for chunk in document_chunks], embeddings),
+                    embedding = self.embedding_function,
+                    metadatas = [chunk.metadata for chunk in document_chunks]
+                    )
+        with self.lock:
+            self.vector_db = vector_db
+            self.document_names = document_names
+            self.db_version += 1 # Invalidates chains built on the previous database
+        logger.info('\tCompleted\n\n')
+
+    def create_quantized_database(self, document_chunks : list, embeddings : list):
+        # Store the vectors as int8 (SQ8) instead of float32, a quarter of the memory to scan per query
+        # Trained on the whole upload, sampled evenly down to at most 1000 vectors
+        texts = [chunk.page_content for chunk in document_chunks]
+        vectors = np.array(embeddings, dtype=np.float32)
+        training_vectors = vectors[np.linspace(0, len(vectors) - 1, min(len(vectors), 1000)).astype(int)]
+        index = faiss.IndexScalarQuantizer(vectors.shape[1], faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+        index.sq.rangestat_arg = 0.1 # Widen the trained range, vectors outside the sample may fall slightly outside it
+        index.train(training_vectors)
+        vector_db = FAISS(self.embedding_function, index, InMemoryDocstore(), {})
+        vector_db.add_embeddings(zip(texts, embeddings), [chunk.metadata for chunk in document_chunks])
+        return vector_db
+
+    def save_database(self):
+        # Write the index and docstore to the persist directory, if one is configured
+        # Both go into one file that is written to a temp file and moved into place,
+        # so a crash or a concurrent upload can't leave a mismatched index and docstore behind
+        persist_directory = self.config['embedding_options']['persist_directory']
+        if not persist_directory:
+            return
+        with self.save_lock:
+            with self.lock:
+                vector_db, document_names = self.vector_db, self.document_names
+            if vector_db is None:
+                return
+            logger.info('Saving vector_db')
+            os.makedirs(persist_directory, exist_ok=True)
+            with NamedTemporaryFile(dir=persist_directory, suffix='.tmp', delete=False) as file:
+                pickle.dump(
+                    (faiss.serialize_index(vector_db.index), vector_db.docstore, vector_db.index_to_docstore_id, document_names),
+                    file
+                    )
+            try:
+                os.replace(file.name, os.path.join(persist_directory, 'vector_db.pkl'))
+            except OSError:
+                os.remove(file.name)
+                raise
+        logger.info('\tCompleted\n\n')
+
+    def load_database(self, openai_api_key : str):
+        # Warm-load a previously saved database, only tried once per process
+        persist_directory = self.config['embedding_options']['persist_directory']
+        with self.lock:
+            if self.database_loaded or self.vector_db is not None or not persist_directory:
+                return
+            self.database_loaded = True
+            database_path = os.path.join(persist_directory, 'vector_db.pkl')
+            if not os.path.exists(database_path):
+                return
+            logger.info('Loading vector_db from disk')
+            self.create_embedding_function(openai_api_key)
+            with open(database_path, 'rb') as file:
+                index, docstore, index_to_docstore_id, document_names = pickle.load(file)
+            # Only set once everything is read, a broken file leaves the database empty
+            self.vector_db = FAISS(self.embedding_function, faiss.deserialize_index(index), docstore, index_to_docstore_id)
+            self.document_names = document_names
+            self.db_version += 1
         logger.info('\tCompleted\n\n')
-        self.document_names = document_names
 
     def create_llm(self, openai_api_key : str, temperature : int):
         # Instantiate the llm object 
         logger.info('Instantiating the llm')
-        self.llm = ChatOpenAI(
+        model_kwargs = {}
+        if self.config.get('latency_mode') == 'optimized':
+            # Request the provider's low-latency priority processing for this synchronous query
+            model_kwargs['extra_body'] = {'service_tier': 'priority'}
+        return ChatOpenAI(
             model_name=self.config['llm'],
             temperature=temperature,
-            api_key=openai_api_key
+            api_key=openai_api_key,
+            model_kwargs=model_kwargs
             )
-        
 
-    def create_chain(self, prompt_mode : str, source : str):
+
+    def get_reranker(self):
+        # Load the cross-encoder once, it is reused for every chain
+        # Returns None if sentence-transformers is not installed, queries then run without reranking
+        if self.reranker is None:
+            try:
+                from sentence_transformers import CrossEncoder
+            except ImportError:
+                logger.error(
+                    'Could not import sentence_transformers, needed for reranking, continuing without it. '
+                    'Install it with `pip install sentence-transformers` or disable rerank_options.use_reranker'
+                    )
+                return None
+            logger.info('Loading reranker')
+            self.reranker = CrossEncoderRerank(
+                model=CrossEncoder(self.config['rerank_options']['model']),
+                top_n=self.config['rerank_options']['rerank_k']
+                )
+        return self.reranker
+
+    def create_chain(self, llm, prompt_mode : str, source : str):
+        # Returns the chain instead of storing it, the VectorDB instance is shared by all sessions
         logger.info('Creating chain from template')
         if prompt_mode == 'Restricted':
             # Build prompt template
@@ -68,17 +262,26 @@ class VectorDB():
 
         # Build QuestionAnswer chain
         if source == 'Uploaded documents':
-            self.qa_chain = RetrievalQA.from_chain_type(
-                self.llm,
-                retriever=self.vector_db.as_retriever(
-                    search_type="similarity", # mmr, similarity_score_threshold, similarity
-                    search_kwargs = {
-                        "k": 3,                     #k: Amount of documents to return (Default: 4)
-                        'score_threshold': 0.5,     # Minimum relevance threshold for similarity_score_threshold
-                        'fetch_k': 5,              # Amount of documents to pass to MMR algorithm (Default: 20)
-                        'lambda_mult': 0.5,         # Diversity of results returned by MMR; 1 for minimum diversity and 0 for maximum. (Default: 0.5)
-                        }
-                ),
+            reranker = self.get_reranker() if self.config['rerank_options']['use_reranker'] else None
+            retriever = self.vector_db.as_retriever(
+                search_type="similarity", # mmr, similarity_score_threshold, similarity
+                search_kwargs = {
+                    # k: Amount of documents to return (Default: 4), fetch more candidates when reranking
+                    "k": self.config['rerank_options']['fetch_k'] if reranker else 3,
+                    'score_threshold': 0.5,     # Minimum relevance threshold for similarity_score_threshold
+                    'fetch_k': 5,              # Amount of documents to pass to MMR algorithm (Default: 20)
+                    'lambda_mult': 0.5,         # Diversity of results returned by MMR; 1 for minimum diversity and 0 for maximum. (Default: 0.5)
+                    }
+            )
+            if reranker:
+                # Rescore the candidates and only pass the best ones into the prompt
+                retriever = ContextualCompressionRetriever(
+                    base_compressor=reranker,
+                    base_retriever=retriever
+                    )
+            qa_chain = RetrievalQA.from_chain_type(
+                llm,
+                retriever=retriever,
                 return_source_documents=True,
                 chain_type_kwargs={"prompt": qa_chain_prompt}
                 )
@@ -90,21 +293,33 @@ class VectorDB():
                 doc_content_chars_max = 4000,
                 features="lxml"
                 )
-            self.qa_chain = RetrievalQA.from_chain_type(
-                self.llm,
+            qa_chain = RetrievalQA.from_chain_type(
+                llm,
                 retriever=wiki_retriever,
                 return_source_documents=True,
                 chain_type_kwargs={"prompt": qa_chain_prompt}
                 )
             
         logger.info('\tCompleted')
+        return qa_chain
     
-    def get_response(self, user_input : str):
+    def get_response(self, user_input : str, qa_chain, semantic_cache : SemanticCache = None):
         # Query and Response
         logger.info('Getting response from server')
+
+        # Return a cached response for (nearly) identical queries, skipping retrieval and the llm
+        if semantic_cache is not None:
+            query_embedding = self.embedding_function.embed_query(user_input)
+            result = semantic_cache.get(query_embedding)
+            if result is not None:
+                logger.info('\tServed from semantic cache\n\n')
+                return result
+
         with get_openai_callback() as cb:
-            result = self.qa_chain({"query": user_input})
+            result = qa_chain({"query": user_input})
             logger.info(f"\n{cb}")
+        if semantic_cache is not None:
+            semantic_cache.add(query_embedding, result)
         logger.info('\tCompleted\n\n')
         return result
 